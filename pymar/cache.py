@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import hashlib
+import inspect
+import logging
+import os
+import re
+import tempfile
+import time
+
+from collections import OrderedDict
+
+
+def fingerprint(*values):
+    """Returns stable hash of values. It is the same in all processes, unlike the built-in hash."""
+    return hashlib.sha1(pickle.dumps(values, 2)).hexdigest()
+
+
+def code_fingerprint(code):
+    """Returns hash of the code object, which does not depend on the place where it is defined."""
+    consts = tuple(code_fingerprint(const) if inspect.iscode(const) else repr(const)
+                   for const in code.co_consts)
+    return fingerprint(code.co_code, consts, code.co_names, code.co_varnames)
+
+
+#Default repr of objects contains their address, which is different in each process
+ADDRESS_REPR = re.compile(r" at 0x[0-9a-fA-F]+>")
+
+
+def data_fingerprint(value):
+    """Returns repr of the value, or hash of its pickle if repr contains the address of an object."""
+    text = repr(value)
+    if not ADDRESS_REPR.search(text):
+        return text
+    try:
+        return fingerprint(value)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        logging.getLogger("ResultCache").warning(
+            "Cannot fingerprint %s, its results will not be found by other processes: %s" % (text, e))
+        return text
+
+
+def value_fingerprint(value, seen=frozenset()):
+    """Returns hash of the value: of the code for functions and classes, of repr or pickle for the rest."""
+    if inspect.isclass(value):
+        return class_fingerprint(value)
+    if callable(value) or isinstance(value, (staticmethod, classmethod)):
+        return function_fingerprint(value, seen)
+    return data_fingerprint(value)
+
+
+def function_fingerprint(function, seen=frozenset()):
+    """Returns hash of the code of the function (static method, class method)
+    and of the values of the variables of its closure.
+    Functions called from it by global names are not taken into account.
+    """
+    function = getattr(function, "__func__", function)
+    code = getattr(function, "__code__", None)
+    if code is None:
+        #Built-in function or callable object
+        return fingerprint(getattr(function, "__module__", None),
+                           getattr(function, "__name__", None) or data_fingerprint(function))
+
+    closure = []
+    #Recursive functions are in their own closure
+    if function not in seen:
+        for cell in function.__closure__ or ():
+            try:
+                closure.append(value_fingerprint(cell.cell_contents, seen | {function}))
+            except ValueError:
+                #Variable is not assigned yet
+                closure.append(None)
+    return fingerprint(code_fingerprint(code), repr(function.__defaults__), closure)
+
+
+def class_fingerprint(cls, ignore=(), skip_classes=()):
+    """Returns hash of the class: its name, code of its methods and values of its attributes,
+    including inherited ones (for example, interval and dx of data source).
+    Attributes named in ignore and members of skip_classes are not taken into account.
+    """
+    members = []
+    for klass in inspect.getmro(cls):
+        if klass is object or klass in skip_classes:
+            continue
+        for name, value in sorted(vars(klass).items()):
+            if name in ("__dict__", "__weakref__", "__module__", "__doc__") or name in ignore:
+                continue
+            if isinstance(value, property):
+                value = value.fget
+            members.append((name, value_fingerprint(value)))
+    return fingerprint(cls.__module__, cls.__name__, members)
+
+
+class ResultCache(object):
+    """Stores results of calculations in memory and, if directory is set, on disk,
+    so that they are available to other processes and after restart.
+
+    Results older than ttl seconds are considered missing (0 means that they never expire).
+    No more than max_entries results are kept in memory, and no more than max_disk_size bytes on disk
+    (0 means unlimited). When the limits are exceeded, least recently used results are removed.
+
+    Results which are too large to keep in memory may be read and written with memory=False:
+    then they are only on disk.
+
+    Directory is scanned for expired results every EVICT_INTERVAL writes, and whenever the results
+    written since the last scan exceed max_disk_size. So results written by other processes
+    may exceed max_disk_size until the next scan.
+    """
+
+    #Number of writes between the scans of the directory
+    EVICT_INTERVAL = 100
+
+    def __init__(self, directory=None, ttl=0, max_entries=1000, max_disk_size=0):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_size = max_disk_size
+        self.memory = OrderedDict()
+        #Size of the directory, estimated since the last scan (None if it was not scanned yet)
+        self.disk_size = None
+        self.writes = 0
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def expired(self, stored, now):
+        return self.ttl > 0 and now - stored > self.ttl
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.pickle" % key)
+
+    def get(self, key, default=None, memory=True):
+        now = time.time()
+        if key in self.memory:
+            stored, value = self.memory.pop(key)
+            if not self.expired(stored, now):
+                #Move to the end as the most recently used
+                self.memory[key] = (stored, value)
+                return value
+
+        if not self.directory:
+            return default
+
+        path = self.path(key)
+        try:
+            stored = os.path.getmtime(path)
+            if self.expired(stored, now):
+                os.remove(path)
+                return default
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            #Access time is used to find least recently used results
+            os.utime(path, (now, stored))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+        if memory:
+            self.remember(key, stored, value)
+        return value
+
+    def set(self, key, value, memory=True):
+        now = time.time()
+        if memory:
+            self.remember(key, now, value)
+        else:
+            self.memory.pop(key, None)
+
+        if self.directory:
+            #Write to temporary file first, so that other processes never read incomplete results
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.rename(temp_path, self.path(key))
+
+            self.writes += 1
+            if self.disk_size is not None:
+                self.disk_size += size
+            if self.disk_size is None or self.writes >= self.EVICT_INTERVAL \
+                    or (self.max_disk_size and self.disk_size > self.max_disk_size):
+                self.evict()
+
+    def remember(self, key, stored, value):
+        self.memory.pop(key, None)
+        self.memory[key] = (stored, value)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        """Removes expired results from disk, and the least recently used ones if max_disk_size is exceeded."""
+        now = time.time()
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pickle"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if self.expired(stat.st_mtime, now):
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in files)
+        if self.max_disk_size:
+            for _, size, path in sorted(files):
+                if total_size <= self.max_disk_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_size -= size
+
+        self.disk_size = total_size
+        self.writes = 0
+
+    def clear(self):
+        self.memory.clear()
+        self.disk_size = None
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith(".pickle"):
+                    os.remove(os.path.join(self.directory, name))
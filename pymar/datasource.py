@@ -3,6 +3,8 @@
 
 import inspect
 
+from pymar.cache import fingerprint, class_fingerprint
+
 
 class DataSource(object):
     """Base class for all data sources in your programs.
@@ -37,6 +39,24 @@ class DataSource(object):
         raise NotImplementedError()
 
 
+class MaterializedDataSource(object):
+    """Keeps all the elements of data source in memory, so that it may be iterated many times
+    without building them again. Other attributes are taken from the original data source.
+    """
+    def __init__(self, data_source):
+        self.data_source = data_source
+        self.data = list(data_source)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getattr__(self, name):
+        return getattr(self.data_source, name)
+
+
 #Part of an iterable object
 def get_part(data, limit, offset):
     for index, value in enumerate(data):
@@ -53,6 +73,9 @@ class DataSourceFactory(object):
     Producer sends to workers an object of DataSourceFactory, and data sources are created on workers.
     """
 
+    #Fingerprint of the whole data set, shared by all its parts. Calculated on demand.
+    _source_fingerprint = None
+
     def __init__(self, data, limit=0, offset=0):
         if inspect.isclass(data):
             self.init_from_data_source(data, limit, offset)
@@ -78,14 +101,31 @@ class DataSourceFactory(object):
         self.offset = 0
 
     def part(self, limit, offset):
+        """Returns factory of the part of data. Offset is counted from the beginning of the data of this factory."""
         if self.data:
             data = list(get_part(self.data, limit, offset))
             new_factory = DataSourceFactory(data)
-            return new_factory
+        else:
+            new_factory = DataSourceFactory(self.data_source_class, limit, self.offset + offset)
 
-        new_factory = DataSourceFactory(self.data_source_class, limit, offset)
+        #Position of the part in the whole data set
+        new_factory.offset = self.offset + offset
+        new_factory._source_fingerprint = self._source_fingerprint
         return new_factory
 
+    def source_fingerprint(self):
+        """Stable hash of the whole data set, independent from limit and offset."""
+        if self._source_fingerprint is None:
+            if self.data:
+                self._source_fingerprint = fingerprint(self.data)
+            else:
+                self._source_fingerprint = class_fingerprint(self.data_source_class)
+        return self._source_fingerprint
+
+    def fingerprint(self):
+        """Stable hash of the data of this factory."""
+        return fingerprint(self.source_fingerprint(), self.offset, self.limit)
+
     def length(self):
         return self.limit
 
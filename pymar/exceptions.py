@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+class TimeOutException(Exception):
+    """Raised by producer if workers did not finish the task in time."""
+    pass
+
+
+class TaskCancelledException(Exception):
+    """Raised by worker to abort calculations of the task cancelled by producer."""
+    pass
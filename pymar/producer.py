@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import cPickle as pickle
+import inspect
 import logging
 import pika
+import time
 import uuid
 
 from threading import Timer
 
+from pymar.cache import class_fingerprint, fingerprint, function_fingerprint
 from pymar.exceptions import TimeOutException
+from pymar.session import Session
+from pymar.shuffle import group_pairs
+from pymar.store import SpillStore
 
 logging.basicConfig(logging=logging.DEBUG,
                             format="%(asctime)s [%(levelname)s] [%(name)s]: %(message)s")
@@ -32,16 +38,47 @@ class Producer(object):
 
     If some workers die in progress, tasks will just be reassigned to other workers by MQ server. So, even one worker
     is always enough to complete the whole task (not optimally, although).
+
+    All the producers of the same class share one queue. Set MAX_PRIORITY greater than 0 to make it a priority queue,
+    so that tasks sent with higher priority are taken by workers first. (If the queue already exists without priorities,
+    it must be deleted before that: MQ server does not allow to change the arguments of the existing queue.)
+
+    If the answer may become known before all the parts are processed (search, "any", minimum with known lower bound),
+    override determined_fn. When it returns True for some response, the rest of the task is cancelled,
+    and only the received responses are reduced.
+
+    If cache (see pymar.cache.ResultCache) is given, producer stores the response for each part of the task in it,
+    and takes the responses for the same parts of the same data from there instead of sending them to workers again.
+    Data set is identified by its fingerprint (see DataSourceFactory.fingerprint), and producer -
+    by the code of map_fn and reduce_fn and of the methods and attributes of its class, except SCHEDULING_ATTRIBUTES
+    (see pymar.cache.class_fingerprint). So the cached parts are used even if the number of workers is changed.
+    (Functions called from them by global names are not taken into account,
+    so clear the cache or override fingerprint if they change.)
+
+    If responses of workers are too large to keep all of them in memory, set spill_dir.
+    Then responses are written to temporary directory in it as they are received, and reduce_fn gets
+    pymar.store.SpillStore which reads them lazily, one by one. Responses which are lists are read by chunks
+    (see pymar.store.merge_sorted to merge sorted ones). Files are kept until the next task of the producer,
+    so that the result of reduce_fn may read them lazily too. Call close when the producer is not needed anymore
+    to remove the files of the last task (or use the producer as a context manager).
+    With spill_dir, responses are stored only on disk by the cache, so it needs a directory to be of use.
     """
 
     WORKERS_NUMBER = 10
 
-    def __init__(self, mq_server="localhost", local_mode=False):
-        self.unprocessed_request_num = 0
+    #Maximum priority of tasks in the queue. 0 means that the queue has no priorities.
+    MAX_PRIORITY = 0
+
+    #Attributes which affect only the scheduling of the tasks, not their results (see fingerprint)
+    SCHEDULING_ATTRIBUTES = ("WORKERS_NUMBER", "MAX_PRIORITY")
+
+    def __init__(self, mq_server="localhost", local_mode=False, cache=None, spill_dir=None):
         self.responses = []
+        self.cache = cache
+        self.spill_dir = spill_dir
         self.mq_server = mq_server
         self.logging = logging.getLogger(str(self.__class__.__name__))
-        self.correlation_id = str(uuid.uuid4()).replace("_", "")
+        self.start_task()
         self.local_mode = local_mode
         if not self.local_mode:
             try:
@@ -50,12 +87,29 @@ class Producer(object):
                 self.logging.warning("Cannot connect to MQ server. Working locally.")
                 self.local_mode = True
 
+    def close(self):
+        """Removes the responses of the last task from disk and closes the connection to MQ server."""
+        if isinstance(self.responses, SpillStore):
+            self.responses.clear()
+        self.responses = []
+        if not self.local_mode:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def connect(self, mq_server):
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(
             host=mq_server))
 
         self.channel = self.connection.channel()
 
+        self.channel.queue_declare(queue=self.routing_key(), arguments=self.queue_arguments())
+        self.channel.exchange_declare(exchange=self.cancel_exchange(), exchange_type="fanout")
+
         result = self.channel.queue_declare(exclusive=True)
         self.callback_queue = result.method.queue
 
@@ -70,67 +124,250 @@ class Producer(object):
     def reduce_fn(data_source):
         raise NotImplementedError()
 
+    @staticmethod
+    def step_fn(data_source, params):
+        """Map function for one round of iterative session (see session)."""
+        raise NotImplementedError()
+
+    @staticmethod
+    def determined_fn(response):
+        """Returns True if the response of one worker is enough to determine the result of the whole task."""
+        return False
+
+    def start_task(self):
+        """Prepares producer for a new task. Responses for the previous tasks will be ignored."""
+        self.correlation_id = str(uuid.uuid4()).replace("_", "")
+        self.unprocessed_request_num = 0
+        self.received = set()
+        self.result_determined = False
+        self.parts = {}
+
+    def cancel(self):
+        """Cancels the current task: workers drop its parts which are still in the queue
+        and abort the running ones. Responses which still come for it are ignored.
+        """
+        if not self.local_mode:
+            self.logging.info("Cancelling task %s" % self.correlation_id)
+            self.channel.basic_publish(exchange=self.cancel_exchange(),
+                                       routing_key='',
+                                       body=self.correlation_id)
+        self.start_task()
+
     def on_response(self, ch, method, props, body):
         corr_id, index = props.correlation_id.split("_")
         if corr_id == self.correlation_id:
             self.unprocessed_request_num -= 1
+            self.logging.info("Got response for %d-th request, len(data) = %d" % (int(index) + 1, len(body)))
             body = pickle.loads(body)
-            self.logging.info("Got response for %d-th request: %s" % (int(index) + 1, body))
-            self.responses[int(index)] = body
+            self.set_response(int(index), body)
+            #Only parts of map tasks are cached, not the rounds of sessions or shuffle tasks
+            if self.cache is not None and int(index) in self.parts:
+                self.store_in_cache(self.parts[int(index)], body)
+
+    def new_responses(self):
+        """Returns empty container for the responses of the next task. Removes the previous responses from disk."""
+        if isinstance(self.responses, SpillStore):
+            self.responses.clear()
+        if self.spill_dir is None:
+            return []
+        return SpillStore(self.spill_dir)
+
+    def set_response(self, index, response):
+        self.responses[index] = response
+        self.received.add(index)
+        if self.determined_fn(response):
+            self.result_determined = True
 
+    @classmethod
+    def fingerprint(cls):
+        """Stable hash of the code which calculates the results, used as a part of the keys of the cache.
+        Methods of the classes of this module and SCHEDULING_ATTRIBUTES are not taken into account.
+        """
+        library_classes = [klass for klass in inspect.getmro(cls) if klass.__module__ == __name__]
+        return fingerprint(cls.routing_key(),
+                           function_fingerprint(cls.map_fn), function_fingerprint(cls.reduce_fn),
+                           class_fingerprint(cls, ignore=cls.SCHEDULING_ATTRIBUTES, skip_classes=library_classes))
+
+    def cached_ranges(self, data_source_factory):
+        """Returns sorted list of (offset, limit) of the cached parts of the data of the factory.
+        Offsets are counted from the beginning of the data of the factory.
+        """
+        if self.cache is None:
+            return []
+        key = fingerprint(self.fingerprint(), data_source_factory.source_fingerprint())
+        return sorted(((offset - data_source_factory.offset, limit)
+                       for offset, limit in self.cache.get(key, [])
+                       if offset >= data_source_factory.offset),
+                      key=lambda cached_range: (cached_range[0], -cached_range[1]))
+
+    def store_in_cache(self, factory, response):
+        #Spilled responses are too large to keep in memory, so they are cached only on disk
+        self.cache.set(fingerprint(self.fingerprint(), factory.fingerprint()), response,
+                       memory=self.spill_dir is None)
+
+        #Remember the position of the part, so that divide could align the next tasks with it
+        key = fingerprint(self.fingerprint(), factory.source_fingerprint())
+        ranges = self.cache.get(key, [])
+        if (factory.offset, factory.limit) not in ranges:
+            self.cache.set(key, ranges + [(factory.offset, factory.limit)])
+
+    def response_from_cache(self, index, factory):
+        """Sets the response for index-th part from the cache. Returns False if it is not cached."""
+        if self.cache is None:
+            return False
+
+        missing = object()
+        response = self.cache.get(fingerprint(self.fingerprint(), factory.fingerprint()), missing,
+                                  memory=self.spill_dir is None)
+        if response is missing:
+            self.parts[index] = factory
+            return False
+
+        self.logging.info("Took response for %d-th request from cache" % (index + 1))
+        self.set_response(index, response)
+        return True
 
     @classmethod
     def routing_key(cls):
         return cls.__name__
 
+    @classmethod
+    def cancel_exchange(cls):
+        """Name of the exchange used to notify workers about cancelled tasks."""
+        return "%s.cancel" % cls.routing_key()
+
+    @classmethod
+    def queue_arguments(cls):
+        """Arguments of the queue of tasks. Producer and workers must declare the queue with the same arguments."""
+        if cls.MAX_PRIORITY > 0:
+            return {"x-max-priority": cls.MAX_PRIORITY}
+        return None
+
     def workers_number(self):
         return self.WORKERS_NUMBER
 
     def divide(self, data_source_factory):
-        """Divides the task according to the number of workers."""
+        """Divides the task according to the number of workers.
+        If cache is used, the boundaries of the parts are aligned with the cached parts of the same data,
+        so that only new parts have to be calculated.
+        """
         data_length = data_source_factory.length()
         data_interval_length = data_length / self.workers_number() + 1
+        cached_ranges = self.cached_ranges(data_source_factory)
 
         current_index = 0
-        self.responses = []
+        self.responses = self.new_responses()
         while current_index < data_length:
             self.responses.append(0)
             offset = current_index
             limit = min((data_length - current_index, data_interval_length))
+            for cached_offset, cached_limit in cached_ranges:
+                if cached_offset == current_index and cached_offset + cached_limit <= data_length:
+                    limit = cached_limit
+                    break
+                if current_index < cached_offset < current_index + limit:
+                    limit = cached_offset - current_index
+                    break
             yield data_source_factory.part(limit, offset)
             current_index += limit
 
-    def map(self, data_source_factory, timeout=0, on_timeout="local_mode"):
+    def publish(self, index, factory, priority=None, deadline=None, headers=None, message=None):
+        """Sends index-th part of the task to workers.
+        If message is given, it is sent instead of the factory (headers must tell workers how to read it).
+        """
+        headers = dict(headers or {})
+        expiration = None
+        if deadline is not None:
+            #AMQP headers cannot hold floats, so the deadline is sent in milliseconds since the epoch
+            headers["deadline"] = int(deadline * 1000)
+            #MQ server drops the message if no worker takes it before the deadline.
+            expiration = str(max(int((deadline - time.time()) * 1000), 0))
+
+        self.unprocessed_request_num += 1
+        self.logging.info("Sending %d-th message with %d elements" % (index + 1, factory.length()))
+        body = pickle.dumps(factory if message is None else message)
+        self.logging.info("len(data) = %d" % len(body))
+        self.channel.basic_publish(exchange='',
+                                   routing_key=self.routing_key(),
+                                   properties=pika.BasicProperties(
+                                       reply_to=self.callback_queue,
+                                       correlation_id="_".join((self.correlation_id, str(index))),
+                                       priority=priority,
+                                       expiration=expiration,
+                                       headers=headers or None,
+                                   ),
+                                   body=body)
+
+    def wait(self, timeout=0):
+        """Awaits the responses for all the sent parts of the current task.
+        If timeout is set greater than 0 and time has passed, cancels the task and raises TimeOutException.
+        """
+        time_limit_exceeded = [False]
+
+        def on_timeout_func():
+            self.logging.warning("Timeout!")
+            time_limit_exceeded[0] = True
+
+        timer = None
+        if timeout > 0:
+            timer = Timer(timeout, on_timeout_func)
+            timer.start()
+
+        try:
+            while self.unprocessed_request_num:
+                if time_limit_exceeded[0]:
+                    self.cancel()
+                    raise TimeOutException()
+                self.connection.process_data_events()
+        finally:
+            if timer:
+                timer.cancel()
+
+    def session(self, data_source_factory):
+        """Starts iterative session on the data (see pymar.session.Session)."""
+        return Session(self, data_source_factory)
+
+    def map(self, data_source_factory, timeout=0, on_timeout="local_mode",
+            priority=None, deadline=None, max_in_flight=0):
         """Sends tasks to workers and awaits the responses.
         When all the responses are received, reduces them and returns the result.
 
         If timeout is set greater than 0, producer will quit waiting for workers when time has passed.
         If on_timeout is set to "local_mode", after the time limit producer will run tasks locally.
         If on_timeout is set to "fail", after the time limit producer raise TimeOutException.
+
+        priority is the priority of all parts of the task, from 0 to MAX_PRIORITY.
+        deadline is an absolute time (as returned by time.time()) when the result stops being useful.
+        Parts which have not been started before the deadline are skipped by workers and MQ server,
+        and when it comes, producer cancels the task and raises TimeOutException, whatever on_timeout is
+        (the result would be late anyway, so it is not calculated locally).
+
+        If max_in_flight is set greater than 0, producer keeps no more than max_in_flight parts in the queue
+        and sends the next part only when a response is received. So the parts of huge tasks do not fill
+        the shared queue, and the tasks of other producers of the same class are not stuck behind them.
+
+        When the task is abandoned on timeout, or its result is determined before all the responses are received
+        (see determined_fn), the rest of the task is cancelled, so that workers do not waste time on it.
         """
         def local_launch():
             print "Local launch"
-            return self.reduce_fn(
+            if self.cache is not None:
+                missing = object()
+                response = self.cache.get(fingerprint(self.fingerprint(), data_source_factory.fingerprint()), missing)
+                if response is not missing:
+                    return response
+
+            response = self.reduce_fn(
                         self.map_fn(data_source_factory.build_data_source())
                     )
+            if self.cache is not None:
+                self.store_in_cache(data_source_factory, response)
+            return response
 
         if self.local_mode:
             return local_launch()
 
-        for index, factory in enumerate(self.divide(data_source_factory)):
-            self.unprocessed_request_num += 1
-            self.logging.info("Sending %d-th message with %d elements" % (index + 1, factory.length()))
-            self.logging.info("len(data) = %d" % len(pickle.dumps(factory)))
-            self.channel.basic_publish(exchange='',
-                                       routing_key=self.routing_key(),
-                                       properties=pika.BasicProperties(
-                                           reply_to=self.callback_queue,
-                                           correlation_id="_".join((self.correlation_id, str(index))),
-                                       ),
-                                       body=pickle.dumps(factory))
-
-        self.logging.info("Waiting...")
-
+        self.start_task()
         time_limit_exceeded = [False]
 
         def on_timeout_func():
@@ -138,20 +375,149 @@ class Producer(object):
             self.logging.warning("Timeout!")
             time_limit_exceeded[0] = True
 
-        if timeout > 0:
+        deadline_exceeded = False
+        if deadline is not None:
+            time_left = max(deadline - time.time(), 0)
+            deadline_exceeded = timeout <= 0 or time_left <= timeout
+            timeout = min(timeout, time_left) if timeout > 0 else time_left
+
+        self.timer = None
+        if timeout > 0 or deadline is not None:
             self.timer = Timer(timeout, on_timeout_func)
             self.timer.start()
 
-        while self.unprocessed_request_num:
-            if time_limit_exceeded[0]:
-                if on_timeout == "local_mode":
-                    return local_launch()
-
-                assert on_timeout == "fail", "Invalid value for on_timeout: %s" % on_timeout
-                raise TimeOutException()
-
-            self.connection.process_data_events()
+        parts = enumerate(self.divide(data_source_factory))
+        sending = True
+        try:
+            while sending or self.unprocessed_request_num:
+                if self.result_determined:
+                    responses = [self.responses[index] for index in sorted(self.received)]
+                    self.logging.info("Result is determined by %d responses" % len(responses))
+                    self.cancel()
+                    return self.reduce_fn(responses)
+
+                if time_limit_exceeded[0]:
+                    self.cancel()
+                    if on_timeout == "local_mode" and not deadline_exceeded:
+                        return local_launch()
+
+                    assert on_timeout in ("local_mode", "fail"), "Invalid value for on_timeout: %s" % on_timeout
+                    raise TimeOutException()
+
+                while sending and not self.result_determined \
+                        and not (max_in_flight and self.unprocessed_request_num >= max_in_flight):
+                    try:
+                        index, factory = next(parts)
+                    except StopIteration:
+                        sending = False
+                        self.logging.info("Waiting...")
+                        break
+                    if not self.response_from_cache(index, factory):
+                        self.publish(index, factory, priority, deadline)
+
+                if self.unprocessed_request_num:
+                    self.connection.process_data_events()
+        finally:
+            if self.timer:
+                self.timer.cancel()
 
         self.logging.info("Responses: %s" % str(self.responses))
         return self.reduce_fn(self.responses)
 
+
+class ShuffleProducer(Producer):
+    """Producer for tasks with key-value pairs, such as counting of words or aggregating values by keys.
+
+    map_fn must return a sequence of pairs (key, value). Workers do not reduce them, but split them
+    among REDUCERS_NUMBER reducers by keys (see pymar.shuffle.partition). If combine_fn(key, values) is defined,
+    each worker first combines the values of each key in its part of data into one value.
+    When all the parts are mapped, producer sends reducing tasks to workers. Each of them receives all the pairs
+    of its reducer, calls reduce_fn(key, values) for each key, and passes the list of pairs (key, result)
+    to output_fn. Responses of output_fn are passed to collect_fn on producer, and its result is returned by map.
+
+    By default, output_fn returns a dict, and collect_fn merges them into one dict of all the keys.
+    If the result is too large for producer, override output_fn to save it somewhere on workers
+    and return something small instead.
+
+    Cache, determined_fn and the scheduling options of map are not used by shuffle tasks.
+    """
+
+    REDUCERS_NUMBER = 4
+
+    SCHEDULING_ATTRIBUTES = Producer.SCHEDULING_ATTRIBUTES + ("REDUCERS_NUMBER",)
+
+    #Define as static method combine_fn(key, values) to combine values on workers before sending them to reducers
+    combine_fn = None
+
+    @staticmethod
+    def reduce_fn(key, values):
+        raise NotImplementedError()
+
+    @staticmethod
+    def output_fn(pairs):
+        return dict(pairs)
+
+    @staticmethod
+    def collect_fn(outputs):
+        result = {}
+        for output in outputs:
+            result.update(output)
+        return result
+
+    def reducers_number(self):
+        return self.REDUCERS_NUMBER
+
+    def shuffle_prefix(self):
+        """Prefix of the names of the queues of reducers for the current task.
+        Name of the queue of reducer is the prefix and the index of reducer separated by a dot.
+        """
+        return "%s.shuffle.%s" % (self.routing_key(), self.correlation_id)
+
+    def local_launch(self, data_source_factory):
+        groups = group_pairs(self.map_fn(data_source_factory.build_data_source()))
+        output = self.output_fn([(key, self.reduce_fn(key, values)) for key, values in groups.iteritems()])
+        return self.collect_fn([output])
+
+    def map(self, data_source_factory, timeout=0):
+        """Runs map_fn on workers, shuffles the pairs, reduces them on workers and returns collected outputs.
+        If timeout is set greater than 0, producer will raise TimeOutException when time has passed.
+        """
+        if self.local_mode:
+            return self.local_launch(data_source_factory)
+
+        self.start_task()
+        reducers_number = self.reducers_number()
+        prefix = self.shuffle_prefix()
+        queues = ["%s.%d" % (prefix, reducer_index) for reducer_index in range(reducers_number)]
+        for queue in queues:
+            self.channel.queue_declare(queue=queue)
+
+        try:
+            parts_number = 0
+            for index, factory in enumerate(self.divide(data_source_factory)):
+                self.publish(index, factory, headers={"shuffle": prefix, "reducers": reducers_number})
+                parts_number += 1
+            self.logging.info("Mapping...")
+            self.wait(timeout)
+
+            #All the pairs are in the queues of reducers now
+            self.start_task()
+            self.responses = self.new_responses()
+            for index, queue in enumerate(queues):
+                self.responses.append(0)
+                self.unprocessed_request_num += 1
+                self.channel.basic_publish(exchange='',
+                                           routing_key=self.routing_key(),
+                                           properties=pika.BasicProperties(
+                                               reply_to=self.callback_queue,
+                                               correlation_id="_".join((self.correlation_id, str(index))),
+                                               headers={"shuffle_reduce": queue, "parts": parts_number},
+                                           ),
+                                           body='')
+            self.logging.info("Reducing...")
+            self.wait(timeout)
+        finally:
+            for queue in queues:
+                self.channel.queue_delete(queue=queue)
+
+        return self.collect_fn(self.responses)
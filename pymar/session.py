@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import pika
+import uuid
+
+from pymar.datasource import MaterializedDataSource
+
+
+class Session(object):
+    """Iterative session: runs many rounds of calculations on the same data, for example, iterations of k-means.
+
+    In the first round, parts of data are sent to workers as usual. Each worker builds its data source once,
+    keeps all the elements in memory and listens for the next rounds of the session.
+    In each next round, producer sends only the parameters of the round to all the workers at once,
+    and they call step_fn(data_source, params) of the producer on each part they keep.
+    Then responses are reduced with reduce_fn, as in map.
+
+    Use it as a context manager or call close in the end, so that workers free the memory:
+
+        with producer.session(factory) as session:
+            for i in range(10):
+                params = session.run(params)
+
+    If a worker dies, its parts of data are lost, and the next round fails with TimeOutException,
+    so set timeout for the rounds. Workers also forget the data of the session if it has no rounds
+    for a long time (see Worker.SESSION_TIMEOUT).
+    """
+
+    def __init__(self, producer, data_source_factory):
+        self.producer = producer
+        self.data_source_factory = data_source_factory
+        self.session_id = str(uuid.uuid4())
+        self.parts = None
+        self.data_source = None
+
+    def exchange(self):
+        """Name of the exchange used to send parameters of the rounds to the workers which keep the data."""
+        return "%s.session.%s" % (self.producer.routing_key(), self.session_id)
+
+    def headers(self, **kwargs):
+        headers = {"session": self.session_id, "exchange": self.exchange()}
+        headers.update(kwargs)
+        return headers
+
+    def run(self, params, timeout=0):
+        """Runs one round with given parameters and returns the reduced result."""
+        producer = self.producer
+        if producer.local_mode:
+            if self.data_source is None:
+                self.data_source = MaterializedDataSource(self.data_source_factory.build_data_source())
+            return producer.reduce_fn(producer.step_fn(self.data_source, params))
+
+        producer.start_task()
+        if self.parts is None:
+            #The first round: send the data itself
+            producer.channel.exchange_declare(exchange=self.exchange(), exchange_type="fanout", auto_delete=True)
+            self.parts = list(producer.divide(self.data_source_factory))
+            for index, factory in enumerate(self.parts):
+                producer.publish(index, factory, headers=self.headers(), message=(factory, params))
+        else:
+            producer.responses = producer.new_responses()
+            for _ in self.parts:
+                producer.responses.append(0)
+            producer.unprocessed_request_num = len(self.parts)
+            body = pickle.dumps(params)
+            producer.logging.info("Sending parameters of the round, len(data) = %d" % len(body))
+            producer.channel.basic_publish(exchange=self.exchange(),
+                                           routing_key='',
+                                           properties=pika.BasicProperties(
+                                               reply_to=producer.callback_queue,
+                                               correlation_id=producer.correlation_id,
+                                               headers=self.headers(),
+                                           ),
+                                           body=body)
+
+        producer.wait(timeout)
+        return producer.reduce_fn(producer.responses)
+
+    def close(self):
+        """Tells workers to forget the data of the session."""
+        if not self.producer.local_mode and self.parts is not None:
+            self.producer.channel.basic_publish(exchange=self.exchange(),
+                                                routing_key='',
+                                                properties=pika.BasicProperties(
+                                                    headers=self.headers(close=True),
+                                                ),
+                                                body='')
+        self.parts = None
+        self.data_source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import zlib
+
+
+def encode_key(key):
+    """Returns string which is the same for the keys which are equal, such as 'a' and u'a', or 1, 1L and 1.0.
+    Keys of types other than strings, numbers, None, tuples and frozensets of them are encoded with pickle,
+    so they must be pickled in the same way when they are equal.
+    """
+    if isinstance(key, unicode):
+        return "s" + key.encode("utf-8")
+    if isinstance(key, str):
+        return "s" + key
+    if isinstance(key, float) and key.is_integer():
+        key = int(key)
+    if isinstance(key, (bool, int, long)):
+        return "i%d" % key
+    if isinstance(key, float):
+        return "f" + repr(key)
+    if key is None:
+        return "n"
+    if isinstance(key, tuple):
+        return "t" + "".join("%d:%s" % (len(item), item) for item in map(encode_key, key))
+    if isinstance(key, frozenset):
+        return "z" + "".join("%d:%s" % (len(item), item) for item in sorted(map(encode_key, key)))
+    return "p" + pickle.dumps(key, 2)
+
+
+def partition(key, reducers_number):
+    """Returns index of the reducer for the key.
+    Unlike the built-in hash, it is the same on all the machines, so all the pairs with the same key
+    come to the same reducer, no matter which worker sends them.
+    """
+    return zlib.crc32(encode_key(key)) % reducers_number
+
+
+def group_pairs(pairs, groups=None):
+    """Groups values of pairs (key, value) by keys. Returns dict: key -> list of values.
+    If groups is given, values are added to it.
+    """
+    if groups is None:
+        groups = {}
+    for key, value in pairs:
+        groups.setdefault(key, []).append(value)
+    return groups
+
+
+def split_pairs(pairs, reducers_number, combine_fn=None):
+    """Splits pairs (key, value) among reducers.
+    Returns list of reducers_number lists of pairs (key, list of values).
+    If combine_fn is given, values of each key are replaced with one value: combine_fn(key, values).
+    """
+    buckets = [{} for _ in xrange(reducers_number)]
+    for key, value in pairs:
+        buckets[partition(key, reducers_number)].setdefault(key, []).append(value)
+
+    if combine_fn is not None:
+        return [[(key, [combine_fn(key, values)]) for key, values in bucket.iteritems()] for bucket in buckets]
+    return [bucket.items() for bucket in buckets]
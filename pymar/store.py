@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import heapq
+import os
+import shutil
+import tempfile
+
+
+class SpilledRun(object):
+    """Sequence saved on disk by chunks.
+    It is read lazily, chunk by chunk, each time it is iterated, so it never takes much memory.
+    """
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except EOFError:
+                    return
+                for value in chunk:
+                    yield value
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "<%s of %d elements in %s>" % (self.__class__.__name__, self.length, self.path)
+
+
+class SpillStore(object):
+    """List of responses of workers which keeps them in temporary directory on disk instead of memory.
+    Each response is written to disk as soon as it is received, and read again only when it is needed.
+
+    Responses which are lists are written by chunks of CHUNK_SIZE elements and returned as SpilledRun,
+    so that even a response which does not fit in memory may be iterated (see also merge_sorted).
+    Other responses, including tuples, are loaded entirely when they are accessed.
+
+    Iteration over the store loads the responses one by one, so reduce_fn which iterates over its argument
+    only once keeps in memory no more than one response at a time.
+    """
+
+    CHUNK_SIZE = 10000
+
+    def __init__(self, directory=None):
+        self.directory = tempfile.mkdtemp(prefix="pymar_", dir=directory)
+        self.runs = {}
+        self.length = 0
+
+    def path(self, index):
+        return os.path.join(self.directory, "%d.pickle" % index)
+
+    def append(self, value):
+        self.length += 1
+        self[self.length - 1] = value
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.length:
+            raise IndexError("SpillStore index out of range")
+
+        with open(self.path(index), "wb") as f:
+            if isinstance(value, list):
+                for start in xrange(0, len(value), self.CHUNK_SIZE):
+                    pickle.dump(value[start:start + self.CHUNK_SIZE], f, pickle.HIGHEST_PROTOCOL)
+                self.runs[index] = len(value)
+            else:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                self.runs.pop(index, None)
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError("SpillStore index out of range")
+
+        if index in self.runs:
+            return SpilledRun(self.path(index), self.runs[index])
+        with open(self.path(index), "rb") as f:
+            return pickle.load(f)
+
+    def __iter__(self):
+        for index in xrange(self.length):
+            yield self[index]
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "<%s of %d responses in %s>" % (self.__class__.__name__, self.length, self.directory)
+
+    def clear(self):
+        """Removes all the responses from disk."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.runs = {}
+        self.length = 0
+
+
+def merge_sorted(runs, key=None):
+    """Lazily merges sorted sequences (for example, SpilledRun responses) into one sorted sequence.
+    Only one element of each sequence is kept in memory at a time.
+    """
+    if key is None:
+        return heapq.merge(*runs)
+
+    def decorate(index, run):
+        #Index of the sequence makes order stable and prevents comparison of values with equal keys
+        for value in run:
+            yield key(value), index, value
+
+    merged = heapq.merge(*[decorate(index, run) for index, run in enumerate(runs)])
+    return (value for _, _, value in merged)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pymar.cache import ResultCache, class_fingerprint, function_fingerprint
+from pymar.datasource import DataSource, DataSourceFactory
+
+
+class FakeDataSource(DataSource):
+    interval = (1, 10)
+
+    @classmethod
+    def full_length(cls):
+        return 100
+
+    def __iter__(self):
+        return iter(xrange(self.offset, self.offset + self.limit))
+
+
+class Factor(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def multiplier(n):
+    return lambda x: x * n
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_function(self):
+        self.assertEqual(function_fingerprint(lambda x: x * 2), function_fingerprint(lambda x: x * 2))
+        self.assertNotEqual(function_fingerprint(lambda x: x * 2), function_fingerprint(lambda x: x * 3))
+
+    def test_closure(self):
+        self.assertEqual(function_fingerprint(multiplier(2)), function_fingerprint(multiplier(2)))
+        self.assertNotEqual(function_fingerprint(multiplier(2)), function_fingerprint(multiplier(3)))
+
+        def factorial(n):
+            return n * factorial(n - 1) if n else 1
+
+        self.assertEqual(function_fingerprint(factorial), function_fingerprint(factorial))
+
+    def test_object(self):
+        #Default repr of objects differs between processes, so they are fingerprinted by pickle
+        self.assertEqual(function_fingerprint(multiplier(Factor(2))), function_fingerprint(multiplier(Factor(2))))
+        self.assertNotEqual(function_fingerprint(multiplier(Factor(2))), function_fingerprint(multiplier(Factor(3))))
+
+    def test_class(self):
+        fingerprint = class_fingerprint(FakeDataSource)
+        self.assertEqual(fingerprint, class_fingerprint(FakeDataSource))
+
+        #Changing of the attributes of data source changes the data
+        FakeDataSource.interval = (1, 20)
+        try:
+            self.assertNotEqual(fingerprint, class_fingerprint(FakeDataSource))
+        finally:
+            FakeDataSource.interval = (1, 10)
+
+    def test_factory(self):
+        factory = DataSourceFactory(FakeDataSource)
+        self.assertEqual(factory.fingerprint(), DataSourceFactory(FakeDataSource).fingerprint())
+        self.assertEqual(factory.part(10, 20).fingerprint(), DataSourceFactory(FakeDataSource, 10, 20).fingerprint())
+        self.assertNotEqual(factory.part(10, 20).fingerprint(), factory.part(10, 30).fingerprint())
+
+        factory = DataSourceFactory(range(10))
+        self.assertEqual(factory.fingerprint(), DataSourceFactory(range(10)).fingerprint())
+        self.assertNotEqual(factory.fingerprint(), DataSourceFactory(range(11)).fingerprint())
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory(self):
+        cache = ResultCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        #"b" is the least recently used
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = ResultCache(ttl=0.05)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk(self):
+        ResultCache(self.directory).set("a", [1, 2, 3])
+
+        #Results are available to other processes
+        self.assertEqual(ResultCache(self.directory).get("a"), [1, 2, 3])
+        self.assertEqual(ResultCache(self.directory).get("b", "missing"), "missing")
+
+    def test_disk_only(self):
+        cache = ResultCache(self.directory)
+        cache.set("a", [1, 2, 3], memory=False)
+        self.assertEqual(cache.get("a", memory=False), [1, 2, 3])
+        self.assertEqual(len(cache.memory), 0)
+
+    def test_disk_size(self):
+        cache = ResultCache(self.directory, max_disk_size=150)
+        cache.set("a", "a" * 100)
+        os.utime(cache.path("a"), (time.time() - 10, time.time() - 10))
+        cache.set("b", "b" * 100)
+
+        #Only the most recent result fits
+        self.assertFalse(os.path.exists(cache.path("a")))
+        self.assertTrue(os.path.exists(cache.path("b")))
+
+    def test_evict_interval(self):
+        cache = ResultCache(self.directory)
+        cache.EVICT_INTERVAL = 3
+        evictions = []
+        evict = cache.evict
+        cache.evict = lambda: evictions.append(1) or evict()
+        for i in range(7):
+            cache.set(str(i), i)
+
+        #Directory is scanned on the first write, and then every EVICT_INTERVAL writes
+        self.assertEqual(len(evictions), 3)
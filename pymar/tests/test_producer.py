@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from pika.exceptions import AMQPConnectionError
 
-from utils import ProducerMockConnection, ProducerMockChannel
+from utils import ProducerMockConnection, ProducerMockChannel, ProducerQueueMockConnection, ProducerQueueMockChannel, \
+    ProducerSessionMockChannel
 from pymar.producer import Producer
+from pymar.exceptions import TimeOutException
+from pymar.cache import ResultCache
+from pymar.datasource import DataSource, DataSourceFactory
+from pymar.store import SpillStore
 
 
 class MockFactory():
@@ -26,6 +36,15 @@ class MockFactory():
         return range(self.offset, self.limit + self.offset)
 
 
+class RangeDataSource(DataSource):
+    @classmethod
+    def full_length(cls):
+        return 14
+
+    def __iter__(self):
+        return iter(xrange(self.offset, self.offset + self.limit))
+
+
 def params(factories):
     return [factory.params() for factory in factories]
 
@@ -36,6 +55,18 @@ def fake_connect(self, mq_server):
     self.callback_queue = "queue_name"
 
 
+def queue_connect(self, mq_server):
+    self.channel = ProducerQueueMockChannel(self)
+    self.connection = ProducerQueueMockConnection(self.channel)
+    self.callback_queue = "queue_name"
+
+
+def session_connect(self, mq_server):
+    self.connection = ProducerMockConnection(self)
+    self.channel = ProducerSessionMockChannel(self)
+    self.callback_queue = "queue_name"
+
+
 def failed_connect(self, mq_server):
     raise AMQPConnectionError()
 
@@ -77,3 +108,204 @@ class TestProducer(unittest.TestCase):
         Producer.reduce_fn = lambda cls, data : sum(data)
         producer = Producer()
         self.assertEqual(producer.map(MockFactory(10)), 2*sum(range(10)))
+
+    def test_priority_and_deadline(self):
+        sent = []
+
+        def basic_publish(**kwargs):
+            sent.append(kwargs["properties"])
+            self.producer.on_response(None, None, kwargs["properties"], kwargs["body"])
+
+        self.producer.channel.basic_publish = basic_publish
+        deadline = time.time() + 60
+        self.producer.map(MockFactory(7), priority=3, deadline=deadline)
+
+        self.assertEqual(len(sent), 4)
+        for properties in sent:
+            self.assertEqual(properties.priority, 3)
+            self.assertEqual(properties.headers, {"deadline": int(deadline * 1000)})
+            #Properties can be sent to MQ server
+            properties.encode()
+            self.assertTrue(0 < int(properties.expiration) <= 60000)
+
+    def test_max_in_flight(self):
+        Producer.connect = queue_connect
+        producer = Producer()
+        producer.workers_number = lambda: 4
+
+        self.assertListEqual(params(producer.map(MockFactory(7), max_in_flight=2)), [
+            (2, 0), (2, 2), (2, 4), (1, 6)
+        ])
+        self.assertEqual(producer.channel.max_queue_length, 2)
+
+    def test_queue_arguments(self):
+        self.assertIsNone(Producer.queue_arguments())
+
+        class PriorityProducer(Producer):
+            MAX_PRIORITY = 5
+
+        self.assertEqual(PriorityProducer.queue_arguments(), {"x-max-priority": 5})
+
+    def test_result_determined(self):
+        Producer.connect = queue_connect
+        producer = Producer()
+        producer.workers_number = lambda: 4
+        producer.determined_fn = lambda response: response.offset == 2
+
+        #Only the received responses are reduced, the rest of the task is cancelled
+        self.assertListEqual(params(producer.map(MockFactory(7))), [
+            (2, 0), (2, 2)
+        ])
+        self.assertEqual(len(producer.channel.cancelled), 1)
+
+    def test_cancel_on_timeout(self):
+        Producer.connect = queue_connect
+        producer = Producer()
+        producer.workers_number = lambda: 4
+        #Workers never respond
+        producer.connection.process_data_events = lambda: time.sleep(0.01)
+
+        self.assertRaises(TimeOutException, producer.map, MockFactory(7), timeout=0.05, on_timeout="fail")
+        self.assertEqual(len(producer.channel.cancelled), 1)
+        self.assertEqual(producer.unprocessed_request_num, 0)
+
+    def test_deadline_exceeded(self):
+        Producer.connect = queue_connect
+        producer = Producer()
+        producer.workers_number = lambda: 4
+        #Workers never respond
+        producer.connection.process_data_events = lambda: time.sleep(0.01)
+
+        #Task is not calculated locally after the deadline
+        self.assertRaises(TimeOutException, producer.map, MockFactory(7), deadline=time.time() - 1)
+        self.assertRaises(TimeOutException, producer.map, MockFactory(7), timeout=10, deadline=time.time() + 0.05)
+        self.assertEqual(len(producer.channel.cancelled), 2)
+
+    def test_cache(self):
+        sent = []
+
+        def basic_publish(**kwargs):
+            factory = pickle.loads(kwargs["body"])
+            sent.append((factory.limit, factory.offset))
+            self.producer.on_response(None, None, kwargs["properties"], kwargs["body"])
+
+        self.producer.cache = ResultCache()
+        self.producer.channel.basic_publish = basic_publish
+        self.producer.reduce_fn = lambda data: [(factory.limit, factory.offset) for factory in data]
+
+        result = self.producer.map(DataSourceFactory(RangeDataSource, 7))
+        self.assertListEqual(result, [(2, 0), (2, 2), (2, 4), (1, 6)])
+        self.assertListEqual(sent, result)
+
+        #The same task is not sent to workers again
+        del sent[:]
+        self.assertListEqual(self.producer.map(DataSourceFactory(RangeDataSource, 7)), result)
+        self.assertListEqual(sent, [])
+
+        #Only new parts of the overlapping task are sent
+        result = self.producer.map(DataSourceFactory(RangeDataSource, 10, 2))
+        self.assertListEqual(result, [(2, 2), (2, 4), (1, 6), (3, 7), (2, 10)])
+        self.assertListEqual(sent, [(3, 7), (2, 10)])
+
+    def test_fingerprint(self):
+        class CachedProducer(Producer):
+            WORKERS_NUMBER = 4
+
+            @staticmethod
+            def helper(x):
+                return x
+
+        fingerprint = CachedProducer.fingerprint()
+
+        #Scheduling settings do not change the keys of the cache
+        CachedProducer.WORKERS_NUMBER = 20
+        self.assertEqual(CachedProducer.fingerprint(), fingerprint)
+
+        #Code which calculates the results does
+        CachedProducer.helper = staticmethod(lambda x: x + 1)
+        self.assertNotEqual(CachedProducer.fingerprint(), fingerprint)
+
+    def test_session(self):
+        Producer.connect = session_connect
+        producer = Producer()
+        producer.workers_number = lambda: 4
+        producer.reduce_fn = lambda data: [(params, factory.params()) for params, factory in data]
+
+        with producer.session(MockFactory(7)) as session:
+            #Exchange of the session is declared only when it is used
+            self.assertListEqual(producer.channel.exchanges, [])
+
+            #Data is sent in the first round only
+            self.assertListEqual(session.run(1), [
+                (1, (2, 0)), (1, (2, 2)), (1, (2, 4)), (1, (1, 6))
+            ])
+            self.assertEqual(len(producer.channel.published), 4)
+            self.assertListEqual(producer.channel.exchanges, [session.exchange()])
+
+            self.assertListEqual(session.run(2), [
+                (2, (2, 0)), (2, (2, 2)), (2, (2, 4)), (2, (1, 6))
+            ])
+            self.assertEqual(len(producer.channel.published), 5)
+            self.assertEqual(pickle.loads(producer.channel.published[-1]["body"]), 2)
+
+        #Workers forget the data
+        self.assertEqual(producer.channel.parts, {})
+
+    def test_session_with_cache(self):
+        Producer.connect = session_connect
+        producer = Producer(cache=ResultCache())
+        producer.workers_number = lambda: 4
+        producer.reduce_fn = lambda data: [params for params, factory in data]
+
+        #Rounds of sessions are not cached
+        with producer.session(DataSourceFactory(RangeDataSource, 7)) as session:
+            self.assertListEqual(session.run(1), [1, 1, 1, 1])
+            self.assertListEqual(session.run(2), [2, 2, 2, 2])
+        self.assertEqual(len(producer.cache.memory), 0)
+
+    def test_local_session(self):
+        Producer.connect = failed_connect
+        Producer.step_fn = staticmethod(lambda data_source, params: (elem*params for elem in data_source))
+        Producer.reduce_fn = lambda cls, data : sum(data)
+        producer = Producer()
+
+        session = producer.session(MockFactory(10))
+        self.assertEqual(session.run(2), 2*sum(range(10)))
+        self.assertEqual(session.run(3), 3*sum(range(10)))
+
+    def test_spill(self):
+        directory = tempfile.mkdtemp()
+        try:
+            Producer.connect = queue_connect
+            producer = Producer(spill_dir=directory)
+            producer.workers_number = lambda: 4
+            received = []
+
+            def reduce_fn(responses):
+                received.append(responses)
+                return params(responses)
+
+            producer.reduce_fn = reduce_fn
+            self.assertListEqual(producer.map(MockFactory(7)), [
+                (2, 0), (2, 2), (2, 4), (1, 6)
+            ])
+            self.assertIsInstance(received[0], SpillStore)
+
+            #Files of the previous task are removed
+            producer.map(MockFactory(7))
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            #Cache keeps spilled responses only on disk
+            producer.cache = ResultCache(os.path.join(directory, "cache"))
+            producer.reduce_fn = lambda responses: None
+            producer.map(DataSourceFactory(RangeDataSource, 7))
+            self.assertEqual(len(producer.cache.memory), 1)
+            self.assertEqual(len(os.listdir(producer.cache.directory)), 5)
+            shutil.rmtree(producer.cache.directory)
+
+            #Files of the last task are removed when the producer is closed
+            producer.close()
+            self.assertListEqual(os.listdir(directory), [])
+            self.assertTrue(producer.connection.closed)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pika
+import sys
+import unittest
+
+from utils import MockBroker
+from pymar.cache import ResultCache
+from pymar.datasource import DataSourceFactory
+from pymar.producer import ShuffleProducer
+from pymar.shuffle import encode_key, partition, group_pairs, split_pairs
+
+sys.path.append("../..")
+import worker
+
+
+class WordCountProducer(ShuffleProducer):
+    REDUCERS_NUMBER = 3
+    WORKERS_NUMBER = 2
+
+    @staticmethod
+    def map_fn(data_source):
+        return ((word, 1) for word in data_source)
+
+    @staticmethod
+    def combine_fn(key, values):
+        return sum(values)
+
+    @staticmethod
+    def reduce_fn(key, values):
+        return sum(values)
+
+
+class BrokerPika:
+    """Connects workers to the broker in memory."""
+    BasicProperties = pika.BasicProperties
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def BlockingConnection(self, *args, **kwargs):
+        return self.broker
+
+    def ConnectionParameters(self, *args, **kwargs):
+        pass
+
+
+WORDS = "a b a c b a d".split()
+
+
+class TestShuffle(unittest.TestCase):
+
+    def test_partition(self):
+        for key in ["a", 1, ("a", 1)]:
+            self.assertEqual(partition(key, 4), partition(key, 4))
+            self.assertIn(partition(key, 4), range(4))
+
+    def test_equal_keys(self):
+        #Keys which are equal must come to the same reducer
+        t, s = ("a", 1), ("a", 1)
+        for keys in [("a", u"a"), (1, 1L, 1.0, True), ((t, t), (s, t)), (("a", 1), (u"a", 1.0)),
+                     (frozenset([1, 2]), frozenset([2.0, 1]))]:
+            for reducers_number in range(1, 10):
+                self.assertEqual(len(set(partition(key, reducers_number) for key in keys)), 1, keys)
+
+        self.assertNotEqual(encode_key(1.5), encode_key(1))
+        self.assertNotEqual(encode_key(("ab", "c")), encode_key(("a", "bc")))
+
+    def test_group_pairs(self):
+        self.assertEqual(group_pairs([("a", 1), ("b", 2), ("a", 3)]), {"a": [1, 3], "b": [2]})
+
+    def test_split_pairs(self):
+        pairs = [(word, 1) for word in WORDS]
+        buckets = split_pairs(pairs, 3)
+        self.assertEqual(len(buckets), 3)
+        for reducer_index, bucket in enumerate(buckets):
+            for key, values in bucket:
+                self.assertEqual(partition(key, 3), reducer_index)
+                self.assertEqual(values, [1] * WORDS.count(key))
+
+        #Combined values
+        buckets = split_pairs(pairs, 3, lambda key, values: sum(values))
+        self.assertEqual(dict(sum(buckets, [])), {"a": [3], "b": [2], "c": [1], "d": [1]})
+
+    def test_local_mode(self):
+        producer = WordCountProducer(local_mode=True)
+        self.assertEqual(producer.map(DataSourceFactory(WORDS)), {"a": 3, "b": 2, "c": 1, "d": 1})
+
+    def test_shuffle_task(self):
+        broker = MockBroker()
+        worker.pika = BrokerPika(broker)
+        worker.Worker(WordCountProducer, 0)
+
+        def connect(self, mq_server):
+            self.connection = self.channel = broker
+            self.callback_queue = "queue_name"
+            broker.basic_consume(self.on_response, queue=self.callback_queue)
+
+        WordCountProducer.connect = connect
+        producer = WordCountProducer(cache=ResultCache())
+        self.assertEqual(producer.map(DataSourceFactory(WORDS)), {"a": 3, "b": 2, "c": 1, "d": 1})
+
+        #Parts of shuffle tasks are not cached
+        self.assertEqual(len(producer.cache.memory), 0)
+
+        #Queues of reducers are removed
+        self.assertListEqual([queue for queue in broker.queues if ".shuffle." in queue], [])
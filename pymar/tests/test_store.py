@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymar.store import SpillStore, SpilledRun, merge_sorted
+
+
+class TestSpillStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        store = SpillStore(self.directory)
+        store.append(0)
+        store.append(0)
+        store[0] = {"a": 1}
+        store[1] = 5
+
+        self.assertEqual(len(store), 2)
+        self.assertListEqual(list(store), [{"a": 1}, 5])
+        self.assertRaises(IndexError, store.__setitem__, 2, 0)
+
+    def test_runs(self):
+        store = SpillStore(self.directory)
+        store.CHUNK_SIZE = 3
+        store.append(range(10))
+
+        #Lists are read lazily and may be iterated many times
+        run = store[0]
+        self.assertIsInstance(run, SpilledRun)
+        self.assertEqual(len(run), 10)
+        self.assertListEqual(list(run), range(10))
+        self.assertListEqual(list(run), range(10))
+
+    def test_tuples(self):
+        store = SpillStore(self.directory)
+        store.CHUNK_SIZE = 3
+        store.append(tuple(range(10)))
+
+        #Tuples are not split, so they may be indexed
+        self.assertEqual(store[0], tuple(range(10)))
+        self.assertEqual(store[0][5], 5)
+
+    def test_clear(self):
+        store = SpillStore(self.directory)
+        store.append(1)
+        store.clear()
+
+        self.assertEqual(len(store), 0)
+        self.assertListEqual(os.listdir(self.directory), [])
+
+
+class TestMergeSorted(unittest.TestCase):
+
+    def test_merge(self):
+        runs = [[1, 4, 7], [2, 5, 8], [0, 3, 6, 9]]
+        self.assertListEqual(list(merge_sorted(runs)), range(10))
+
+    def test_key(self):
+        runs = [[(1, "b"), (3, "b")], [(1, "a"), (2, "a")]]
+        self.assertListEqual(list(merge_sorted(runs, key=lambda pair: pair[0])), [
+            (1, "b"), (1, "a"), (2, "a"), (3, "b")
+        ])
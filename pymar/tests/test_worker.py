@@ -4,6 +4,7 @@
 import unittest
 import cPickle as pickle
 import sys
+import time
 
 from utils import WorkerMockConnection as MockConnection, WorkerMockChannel as MockChannel
 
@@ -22,10 +23,45 @@ class FakeProducer:
     def reduce_fn(data_source):
         return sum(data_source)
 
+    @staticmethod
+    def step_fn(data_source, params):
+        return (x*params for x in data_source)
+
     @staticmethod
     def routing_key():
         return 1
 
+    @staticmethod
+    def queue_arguments():
+        return None
+
+    @staticmethod
+    def cancel_exchange():
+        return "cancel"
+
+
+class OtherFakeProducer:
+
+    @staticmethod
+    def map_fn(data_source):
+        return (x*3 for x in data_source)
+
+    @staticmethod
+    def reduce_fn(data_source):
+        return sum(data_source)
+
+    @staticmethod
+    def routing_key():
+        return 2
+
+    @staticmethod
+    def queue_arguments():
+        return None
+
+    @staticmethod
+    def cancel_exchange():
+        return "cancel"
+
 
 class FakeDataSourceFactory:
 
@@ -40,11 +76,13 @@ class FakeProperties:
     def __init__(self):
         self.reply_to = None
         self.correlation_id = 2
+        self.headers = None
 
 
 class FakeMethod:
-    def __init__(self):
+    def __init__(self, routing_key=1):
         self.delivery_tag = None
+        self.routing_key = routing_key
 
 
 class FakePika:
@@ -70,13 +108,116 @@ class TestWorker(unittest.TestCase):
         response = {}
 
     def test_worker(self):
-        global worker
         worker.pika = FakePika()
-        worker = worker.Worker(FakeProducer, 0)
+        fake_worker = worker.Worker(FakeProducer, 0)
         message = pickle.dumps(FakeDataSourceFactory())
 
         #"Send" message to the worker and read the result of calculations
-        worker.on_request(worker.channel, FakeMethod(), FakeProperties(), message)
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), FakeProperties(), message)
         result = pickle.loads(response["response"])
 
-        self.assertEqual(result, sum(x*2 for x in range(3)))
\ No newline at end of file
+        self.assertEqual(result, sum(x*2 for x in range(3)))
+
+    def test_several_producers(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker([FakeProducer, OtherFakeProducer], 0)
+        message = pickle.dumps(FakeDataSourceFactory())
+
+        #Each message is processed by the producer which owns its queue
+        fake_worker.on_request(fake_worker.channel, FakeMethod(2), FakeProperties(), message)
+        self.assertEqual(pickle.loads(response["response"]), sum(x*3 for x in range(3)))
+
+        fake_worker.on_request(fake_worker.channel, FakeMethod(1), FakeProperties(), message)
+        self.assertEqual(pickle.loads(response["response"]), sum(x*2 for x in range(3)))
+
+    def test_expired_deadline(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker(FakeProducer, 0)
+        message = pickle.dumps(FakeDataSourceFactory())
+
+        #Message which came too late is not calculated
+        properties = FakeProperties()
+        properties.headers = {"deadline": int((time.time() - 1) * 1000)}
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), properties, message)
+        self.assertNotIn("response", response)
+
+        properties.headers = {"deadline": int((time.time() + 60) * 1000)}
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), properties, message)
+        self.assertEqual(pickle.loads(response["response"]), sum(x*2 for x in range(3)))
+
+    def test_cancelled_task(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker(FakeProducer, 0)
+        message = pickle.dumps(FakeDataSourceFactory())
+
+        #Parts of the cancelled task are dropped
+        fake_worker.channel.queues[fake_worker.cancel_queue] = ["2"]
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), FakeProperties(), message)
+        self.assertNotIn("response", response)
+        self.assertEqual(fake_worker.channel.acked, 1)
+
+    def test_abort_running_task(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker(FakeProducer, 0)
+        message = pickle.dumps(FakeDataSourceFactory())
+
+        #Task is cancelled while the worker calculates it: the queue is empty when the request comes
+        fake_worker.channel.queues[fake_worker.cancel_queue] = [None, "2"]
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), FakeProperties(), message)
+        self.assertNotIn("response", response)
+        self.assertEqual(fake_worker.channel.acked, 1)
+
+    def test_deleted_reducer_queue(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker(FakeProducer, 0)
+
+        #Producer has abandoned the shuffle task and deleted the queue of reducer
+        fake_worker.connection.deleted_queues.add("shuffle.0")
+        properties = FakeProperties()
+        properties.headers = {"shuffle_reduce": "shuffle.0", "parts": 2}
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), properties, "")
+        self.assertNotIn("response", response)
+        self.assertEqual(fake_worker.channel.acked, 1)
+        #Channel of the worker is still open
+        self.assertTrue(fake_worker.channel.is_open)
+
+    def test_session(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker(FakeProducer, 0)
+
+        #The first round brings the data
+        properties = FakeProperties()
+        properties.correlation_id = "2_0"
+        properties.headers = {"session": "session", "exchange": "exchange"}
+        message = pickle.dumps((FakeDataSourceFactory(), 5))
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), properties, message)
+        self.assertEqual(pickle.loads(response["response"]), sum(x*5 for x in range(3)))
+
+        #The next rounds bring only parameters
+        properties.correlation_id = "3"
+        fake_worker.on_session(fake_worker.channel, FakeMethod(), properties, pickle.dumps(7))
+        self.assertEqual(pickle.loads(response["response"]), sum(x*7 for x in range(3)))
+
+        properties.headers = {"session": "session", "exchange": "exchange", "close": True}
+        fake_worker.on_session(fake_worker.channel, FakeMethod(), properties, "")
+        self.assertEqual(fake_worker.sessions, {})
+
+    def test_session_expiration(self):
+        worker.pika = FakePika()
+        fake_worker = worker.Worker(FakeProducer, 0)
+
+        properties = FakeProperties()
+        properties.correlation_id = "2_0"
+        properties.headers = {"session": "session", "exchange": "exchange"}
+        fake_worker.on_request(fake_worker.channel, FakeMethod(), properties, pickle.dumps((FakeDataSourceFactory(), 5)))
+        self.assertEqual(len(fake_worker.connection.timeouts), 1)
+
+        #Session is kept while it is used
+        fake_worker.connection.timeouts.pop()()
+        self.assertIn("session", fake_worker.sessions)
+
+        #Producer has not sent rounds for too long
+        fake_worker.session_times["session"] -= fake_worker.SESSION_TIMEOUT + 1
+        fake_worker.connection.timeouts.pop()()
+        self.assertEqual(fake_worker.sessions, {})
+        self.assertEqual(fake_worker.connection.timeouts, [])
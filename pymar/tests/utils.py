@@ -1,6 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cPickle as pickle
+import pika
+from pika.exceptions import ChannelClosed
+
+
+class MockQueueDeclareResult:
+    class method:
+        queue = "exclusive_queue"
+
 
 class MockChannel:
 
@@ -8,6 +17,15 @@ class MockChannel:
         pass
 
     def queue_declare(self, *args, **kwargs):
+        return MockQueueDeclareResult()
+
+    def queue_bind(self, *args, **kwargs):
+        pass
+
+    def queue_unbind(self, *args, **kwargs):
+        pass
+
+    def exchange_declare(self, *args, **kwargs):
         pass
 
     def queue_purge(self, *args, **kwargs):
@@ -26,16 +44,91 @@ class MockChannel:
 class ProducerMockChannel(MockChannel):
     def __init__(self, producer=None):
         self.producer = producer
+        self.cancelled = []
 
     def basic_publish(self, **kwargs):
+        if kwargs["exchange"]:
+            self.cancelled.append(kwargs["body"])
+            return
         #Looks as if the request returns immediately without changes.
         if self.producer:
             self.producer.on_response(None, None, kwargs["properties"], kwargs["body"])
 
 
+class ProducerQueueMockChannel(MockChannel):
+    """Keeps requests in the queue until the connection processes data events."""
+    def __init__(self, producer):
+        self.producer = producer
+        self.queue = []
+        self.max_queue_length = 0
+        self.cancelled = []
+
+    def basic_publish(self, **kwargs):
+        if kwargs["exchange"]:
+            self.cancelled.append(kwargs["body"])
+            return
+        self.queue.append(kwargs)
+        self.max_queue_length = max(self.max_queue_length, len(self.queue))
+
+
+class ProducerSessionMockChannel(MockChannel):
+    """Works as workers which keep the parts of data of iterative sessions.
+    Response for each part is a pair of parameters of the round and the factory of the part.
+    """
+    def __init__(self, producer):
+        self.producer = producer
+        self.parts = {}
+        self.published = []
+        self.exchanges = []
+
+    def exchange_declare(self, exchange, **kwargs):
+        self.exchanges.append(exchange)
+
+    def respond(self, correlation_id, response):
+        self.producer.on_response(None, None, pika.BasicProperties(correlation_id=correlation_id),
+                                  pickle.dumps(response))
+
+    def basic_publish(self, **kwargs):
+        self.published.append(kwargs)
+        properties = kwargs["properties"]
+        if properties.headers.get("close"):
+            self.parts.clear()
+        elif kwargs["exchange"]:
+            #Round of the session: only parameters are sent
+            params = pickle.loads(kwargs["body"])
+            for index, factory in sorted(self.parts.items()):
+                self.respond("%s_%d" % (properties.correlation_id, index), (params, factory))
+        else:
+            factory, params = pickle.loads(kwargs["body"])
+            self.parts[int(properties.correlation_id.split("_")[1])] = factory
+            self.respond(properties.correlation_id, (params, factory))
+
+
 class WorkerMockChannel(MockChannel):
-    def __init__(self, response):
+    def __init__(self, response, deleted_queues=()):
         self.response = response
+        self.acked = 0
+        #Bodies of the messages in the queues. None stands for the moment when the queue is empty.
+        self.queues = {}
+        self.deleted_queues = deleted_queues
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def basic_get(self, queue, **kwargs):
+        if queue in self.deleted_queues:
+            #MQ server closes the channel
+            self.is_open = False
+            raise ChannelClosed(404, "NOT_FOUND - no queue '%s'" % queue)
+        messages = self.queues.get(queue)
+        body = messages.pop(0) if messages else None
+        if body is None:
+            return None, None, None
+        return MockBrokerMethod(queue), None, body
+
+    def basic_ack(self, *args, **kwargs):
+        self.acked += 1
 
     def basic_publish(self, **kwargs):
         self.response["response"] = kwargs["body"]
@@ -49,9 +142,88 @@ class ProducerMockConnection:
         return ProducerMockChannel()
 
 
+class ProducerQueueMockConnection:
+    def __init__(self, channel):
+        self._channel = channel
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def channel(self):
+        return self._channel
+
+    def process_data_events(self, *args, **kwargs):
+        #Returns the response for the first request in the queue
+        if self._channel.queue:
+            kwargs = self._channel.queue.pop(0)
+            self._channel.producer.on_response(None, None, kwargs["properties"], kwargs["body"])
+
+
 class WorkerMockConnection:
     def __init__(self, response):
         self.response = response
+        #Queues deleted by producers, reading from them closes the channel
+        self.deleted_queues = set()
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback_method):
+        self.timeouts.append(callback_method)
+        return callback_method
 
     def channel(self):
-        return WorkerMockChannel(self.response)
\ No newline at end of file
+        return WorkerMockChannel(self.response, self.deleted_queues)
+
+    def process_data_events(self, *args, **kwargs):
+        pass
+
+class MockBrokerMethod:
+    def __init__(self, routing_key):
+        self.routing_key = routing_key
+        self.delivery_tag = None
+
+
+class MockBroker(MockChannel):
+    """Channel and connection shared by producer and workers. Delivers messages between them in memory."""
+    def __init__(self):
+        self.queues = {}
+        self.consumers = {}
+
+    is_open = True
+
+    def channel(self):
+        return self
+
+    def close(self):
+        pass
+
+    def add_timeout(self, deadline, callback_method):
+        return callback_method
+
+    def basic_consume(self, callback, queue, **kwargs):
+        self.consumers[queue] = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        #Broadcasts are not needed
+        if not exchange:
+            self.queues.setdefault(routing_key, []).append((properties, body))
+
+    def basic_get(self, queue, **kwargs):
+        if not self.queues.get(queue):
+            return None, None, None
+        properties, body = self.queues[queue].pop(0)
+        return MockBrokerMethod(queue), properties, body
+
+    def queue_delete(self, queue, **kwargs):
+        self.queues.pop(queue, None)
+
+    def process_data_events(self, *args, **kwargs):
+        #Delivers the first message from the queues which have consumers
+        for queue, callback in sorted(self.consumers.items()):
+            if self.queues.get(queue):
+                properties, body = self.queues[queue].pop(0)
+                callback(self, MockBrokerMethod(queue), properties, body)
+                return
+
+    def sleep(self, duration):
+        self.process_data_events()
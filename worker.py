@@ -2,67 +2,318 @@
 # -*- coding: utf-8 -*-
 
 import cPickle as pickle
+import collections
 import imp
+import inspect
 import logging
 import multiprocessing as mp
 import os
 import pika
+import time
+from pika.exceptions import ChannelClosed
+
+from pymar.datasource import MaterializedDataSource
+from pymar.exceptions import TaskCancelledException
+from pymar.shuffle import split_pairs
 
 
 class Worker(object):
     """Represents the worker which executes its part of the task
     Connects to MQ server (author used RabbitMQ, but any server supporting AMQP will probably be fine)
-    and listens for messages from producer.
+    and listens for messages from producers.
     Message is a factory which can create data source.
     When it receives a message, it creates a data source using the factory, executes map_fn and reduce_fn
-    of producer_class on the data and sends response with the result.
+    of the corresponding producer class on the data and sends response with the result.
+
+    One worker may serve several producer classes: pass a list of them instead of a single class.
+    Worker listens to the queues of all of them, and the producer class for each message is looked up
+    by its routing key. Worker takes only one message at a time from all its queues,
+    so MQ server shares it fairly between the queues which have messages.
+
+    Messages which have come after their deadline are acknowledged without calculations:
+    the producer is not waiting for them anymore. (Clocks of producer and workers must be synchronized.)
+
+    Producer may cancel its task. Then workers drop its parts which are still in the queue,
+    and the running calculations are aborted: worker checks for cancellation
+    every CANCEL_CHECK_INTERVAL elements returned by map_fn.
+
+    Messages of iterative sessions (see pymar.session.Session) bring parameters of the first round along with the data.
+    Worker keeps the data source of such message in memory and listens for the next rounds of the session,
+    which bring only parameters. Then it calls step_fn of the producer instead of map_fn.
+    If a session has no rounds for SESSION_TIMEOUT seconds, worker forgets its data,
+    so that the producer which died without closing the session does not hold the memory forever.
 
-    If purge_queue is set to True, workers will remove all messages in the queue on connect,
+    For shuffle tasks (see pymar.producer.ShuffleProducer), worker sends the pairs returned by map_fn
+    to the queues of reducers instead of reducing them. Reducing task of shuffle makes worker take all the pairs
+    from the queue of one reducer and reduce them by keys.
+
+    If purge_queue is set to True, workers will remove all messages in the queues on connect,
     to avoid repeating errors.
     """
-    def __init__(self, producer_class, index, mq_server="localhost", purge_queue=False):
-        self.producer_class = producer_class
-        self.logging = logging.getLogger("Worker %d for %s" % (index, producer_class.__name__))
+    #Number of elements processed between the checks for cancellation of the task
+    CANCEL_CHECK_INTERVAL = 1000
+
+    #Number of cancelled tasks the worker remembers
+    CANCELLED_TASKS_NUMBER = 1000
+
+    #Seconds without rounds after which the data of the session is forgotten
+    SESSION_TIMEOUT = 3600
+
+    def __init__(self, producer_classes, index, mq_server="localhost", purge_queue=False):
+        if not isinstance(producer_classes, (list, tuple)):
+            producer_classes = [producer_classes]
+        assert producer_classes, "Worker must serve at least one producer class"
+
+        self.producer_classes = dict((producer_class.routing_key(), producer_class)
+                                     for producer_class in producer_classes)
+        self.logging = logging.getLogger("Worker %d for %s" % (
+            index, ", ".join(producer_class.__name__ for producer_class in producer_classes)))
 
-        #Connect to MQ sever and listen the corresponding queue
+        #Connect to MQ sever and listen the corresponding queues
         connection = pika.BlockingConnection(pika.ConnectionParameters(
             host=mq_server))
         channel = connection.channel()
-        channel.queue_declare(queue=self.producer_class.routing_key())
-        if purge_queue:
-            channel.queue_purge(queue=self.producer_class.routing_key())
-
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(self.on_request, queue=self.producer_class.routing_key())
+        #Prefetch limit is shared by all the queues of the channel
+        channel.basic_qos(prefetch_count=1, all_channels=True)
+        for routing_key in self.producer_classes:
+            channel.queue_declare(queue=routing_key,
+                                  arguments=self.producer_classes[routing_key].queue_arguments())
+            if purge_queue:
+                channel.queue_purge(queue=routing_key)
+            channel.basic_consume(self.on_request, queue=routing_key)
+
+        #Receive notifications about cancelled tasks of all the producers
+        self.cancelled_tasks = collections.deque(maxlen=self.CANCELLED_TASKS_NUMBER)
+        #The queue is polled by is_cancelled rather than consumed: consumer callbacks are not dispatched
+        #while the worker is inside on_request, which is exactly when running tasks have to be checked.
+        self.cancel_queue = channel.queue_declare(exclusive=True).method.queue
+        for producer_class in producer_classes:
+            channel.exchange_declare(exchange=producer_class.cancel_exchange(), exchange_type="fanout")
+            channel.queue_bind(queue=self.cancel_queue, exchange=producer_class.cancel_exchange())
+
+        #Queue for the rounds of iterative sessions, declared on demand
+        self.sessions = {}
+        self.session_times = {}
+        self.session_queue = None
+        self.expiration_timer = None
+
+        self.connection = connection
         self.channel = channel
 
+    def producer_class(self, routing_key):
+        """Returns producer class which serves the queue with given routing key."""
+        return self.producer_classes[routing_key]
+
+    def on_cancel(self, ch, method, props, body):
+        self.logging.info("Task %s is cancelled" % body)
+        self.cancelled_tasks.append(body)
+
+    def is_cancelled(self, task_id):
+        """Takes all the notifications about cancelled tasks from the queue and checks if the task is cancelled."""
+        while True:
+            method, props, body = self.channel.basic_get(queue=self.cancel_queue, no_ack=True)
+            if method is None:
+                break
+            self.on_cancel(self.channel, method, props, body)
+        return task_id in self.cancelled_tasks
+
+    def cancellable(self, task_id, data):
+        """Iterates over data, checking for cancellation of the task every CANCEL_CHECK_INTERVAL elements."""
+        for index, value in enumerate(data):
+            if index % self.CANCEL_CHECK_INTERVAL == 0 and self.is_cancelled(task_id):
+                raise TaskCancelledException(task_id)
+            yield value
+
+    def reduce(self, producer_class, task_id, mapped):
+        """Reduces the result of map_fn or step_fn. Raises TaskCancelledException if the task is cancelled."""
+        if isinstance(mapped, collections.Iterator):
+            mapped = self.cancellable(task_id, mapped)
+        return producer_class.reduce_fn(mapped)
+
+    def respond(self, ch, props, correlation_id, response):
+        ch.basic_publish(exchange='',
+                         routing_key=props.reply_to,
+                         properties=pika.BasicProperties(correlation_id=\
+                                                         correlation_id),
+                         body=pickle.dumps(response))
+
+    def pin(self, producer_class, headers, index, data_source):
+        """Keeps index-th part of the data of the session for its next rounds."""
+        session_id = headers["session"]
+        if session_id not in self.sessions:
+            if self.session_queue is None:
+                self.session_queue = self.channel.queue_declare(exclusive=True).method.queue
+                self.channel.basic_consume(self.on_session, queue=self.session_queue)
+            self.channel.exchange_declare(exchange=headers["exchange"], exchange_type="fanout", auto_delete=True)
+            self.channel.queue_bind(queue=self.session_queue, exchange=headers["exchange"])
+            self.sessions[session_id] = (producer_class, {}, headers["exchange"])
+            if self.expiration_timer is None:
+                self.expiration_timer = self.connection.add_timeout(self.SESSION_TIMEOUT, self.on_expiration_timer)
+
+        self.sessions[session_id][1][index] = data_source
+        self.session_times[session_id] = time.time()
+
+    def forget(self, session_id):
+        """Frees the data of the session and stops listening for its rounds."""
+        _, _, exchange = self.sessions.pop(session_id)
+        del self.session_times[session_id]
+        self.channel.queue_unbind(queue=self.session_queue, exchange=exchange)
+
+    def on_expiration_timer(self):
+        """Forgets the sessions which have had no rounds for SESSION_TIMEOUT seconds."""
+        self.expiration_timer = None
+        now = time.time()
+        for session_id, last_used in self.session_times.items():
+            if now - last_used > self.SESSION_TIMEOUT:
+                self.logging.warning("Session %s has expired" % session_id)
+                self.forget(session_id)
+        if self.sessions:
+            self.expiration_timer = self.connection.add_timeout(self.SESSION_TIMEOUT, self.on_expiration_timer)
+
+    def on_session(self, ch, method, props, body):
+        headers = props.headers
+        session_id = headers["session"]
+        if session_id not in self.sessions:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        producer_class, data_sources, _ = self.sessions[session_id]
+        if headers.get("close"):
+            self.logging.info("Session %s is closed" % session_id)
+            self.forget(session_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        self.session_times[session_id] = time.time()
+        task_id = props.correlation_id
+        params = pickle.loads(body)
+        self.logging.info("Calculating round of session %s for %s..." % (session_id, producer_class.__name__))
+        for index, data_source in sorted(data_sources.items()):
+            if self.is_cancelled(task_id):
+                break
+            try:
+                response = self.reduce(producer_class, task_id, producer_class.step_fn(data_source, params))
+            except TaskCancelledException:
+                self.logging.warning("Task %s is cancelled. Calculations aborted." % task_id)
+                break
+            self.respond(ch, props, "%s_%d" % (task_id, index), response)
+
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def shuffle(self, ch, producer_class, headers, index, pairs):
+        """Sends pairs (key, value) of index-th part of data to the queues of reducers.
+        Returns number of pairs after combining.
+        """
+        buckets = split_pairs(pairs, headers["reducers"], producer_class.combine_fn)
+        for reducer_index, bucket in enumerate(buckets):
+            ch.basic_publish(exchange='',
+                             routing_key="%s.%d" % (headers["shuffle"], reducer_index),
+                             properties=pika.BasicProperties(headers={"part": index}),
+                             body=pickle.dumps(bucket))
+        return sum(len(bucket) for bucket in buckets)
+
+    def shuffle_reduce(self, ch, producer_class, headers, task_id):
+        """Receives the pairs of all the parts of data from the queue of reducer, reduces them by keys
+        and returns the result of output_fn. Raises TaskCancelledException if the task is cancelled.
+
+        Producer deletes the queues of reducers when it abandons the task, and MQ server closes the channel
+        which tries to read from the deleted queue. So the queue is read through a separate channel,
+        and if it is closed, the task is considered cancelled.
+        """
+        channel = self.connection.channel()
+        try:
+            return self.reduce_queue(channel, producer_class, headers, task_id)
+        except ChannelClosed as e:
+            self.logging.warning("Queue of reducer is not available: %s" % e)
+            raise TaskCancelledException(task_id)
+        finally:
+            if channel.is_open:
+                channel.close()
+
+    def reduce_queue(self, ch, producer_class, headers, task_id):
+        queue = headers["shuffle_reduce"]
+        groups = {}
+        received = set()
+        delivery_tags = []
+        while len(received) < headers["parts"]:
+            method, props, body = ch.basic_get(queue=queue)
+            if method is None:
+                #Mappers send pairs before responding to producer, so they must be on the way
+                self.connection.sleep(0.1)
+                if self.is_cancelled(task_id):
+                    raise TaskCancelledException(task_id)
+                continue
+
+            delivery_tags.append(method.delivery_tag)
+            #The same part may come twice if its mapper died before acknowledging the request
+            part = props.headers["part"]
+            if part not in received:
+                received.add(part)
+                for key, values in pickle.loads(body):
+                    groups.setdefault(key, []).extend(values)
+
+        results = [(key, producer_class.reduce_fn(key, values)) for key, values in groups.iteritems()]
+        #Pairs are acknowledged only now, so that they are given to another reducer if this one dies
+        for delivery_tag in delivery_tags:
+            ch.basic_ack(delivery_tag=delivery_tag)
+        return producer_class.output_fn(results)
+
     def on_request(self, ch, method, props, body):
         self.logging.info("\nMessage received")
-        try:
-            data_source_factory = pickle.loads(body)
-        except Exception as e:
-            self.logging.critical("Cannot read data from the message.")
-            self.logging.critical(e)
+        headers = props.headers or {}
+        #Deadline is sent in milliseconds since the epoch
+        deadline = headers.get("deadline")
+        if deadline is not None and deadline / 1000.0 < time.time():
+            self.logging.warning("Deadline of the message has passed. Skipping.")
+            ch.basic_ack(delivery_tag=method.delivery_tag)
             return
 
-        try:
-            data_source = data_source_factory.build_data_source()
-        except Exception as e:
-            self.logging.critical("Cannot create data source: ")
-            self.logging.critical(e)
+        task_id, _, index = str(props.correlation_id).partition("_")
+        if self.is_cancelled(task_id):
+            self.logging.warning("Task %s is cancelled. Skipping." % task_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
             return
 
-        self.logging.info("Calculating...")
-        response = self.producer_class.reduce_fn(
-                        self.producer_class.map_fn(data_source)
-                    )
+        #Reducing tasks of shuffle have no data, it is in the queues of reducers
+        if "shuffle_reduce" not in headers:
+            try:
+                if "session" in headers:
+                    data_source_factory, params = pickle.loads(body)
+                else:
+                    data_source_factory = pickle.loads(body)
+            except Exception as e:
+                self.logging.critical("Cannot read data from the message.")
+                self.logging.critical(e)
+                return
+
+            try:
+                data_source = data_source_factory.build_data_source()
+            except Exception as e:
+                self.logging.critical("Cannot create data source: ")
+                self.logging.critical(e)
+                return
+
+        producer_class = self.producer_class(method.routing_key)
+        self.logging.info("Calculating for %s..." % producer_class.__name__)
+        try:
+            if "shuffle_reduce" in headers:
+                response = self.shuffle_reduce(ch, producer_class, headers, task_id)
+            elif "shuffle" in headers:
+                pairs = self.cancellable(task_id, producer_class.map_fn(data_source))
+                response = self.shuffle(ch, producer_class, headers, int(index), pairs)
+            elif "session" in headers:
+                data_source = MaterializedDataSource(data_source)
+                self.pin(producer_class, headers, int(index), data_source)
+                response = self.reduce(producer_class, task_id, producer_class.step_fn(data_source, params))
+            else:
+                response = self.reduce(producer_class, task_id, producer_class.map_fn(data_source))
+        except TaskCancelledException:
+            self.logging.warning("Task %s is cancelled. Calculations aborted." % task_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
 
         self.logging.info("Calculating finished. ")
-        ch.basic_publish(exchange='',
-                         routing_key=props.reply_to,
-                         properties=pika.BasicProperties(correlation_id=\
-                                                         props.correlation_id),
-                         body=pickle.dumps(response))
+        self.respond(ch, props, props.correlation_id, response)
 
         ch.basic_ack(delivery_tag=method.delivery_tag)
         self.logging.info("Message acknowledged.")
@@ -79,7 +330,9 @@ def parse_options():
                              help="Name of class of data source")
 
     option_parser.add_option("-p", "--producer", dest="producer",
-                             help="Name of class with functions Map and Reduce")
+                             help="Name of class with functions Map and Reduce. "
+                                  "Several names may be separated by commas. "
+                                  "If not specified, all producer classes defined in the file are served.")
 
     option_parser.add_option("-q", "--mq_server", dest="mq_server", default="localhost",
                              help="Address of MQ-server")
@@ -98,9 +351,6 @@ def parse_options():
     if len(args) != 1:
         option_parser.error("Invalid usage")
 
-    if not options.producer:
-        option_parser.error("Name of class of producer is not specified.")
-
     if not options.workers_number:
         option_parser.error("Number of workers is not specified.")
 
@@ -108,11 +358,19 @@ def parse_options():
     return options
 
 
-def run_process(index, producer, mq_server, purge_queue):
-    worker = Worker(producer, index, mq_server=mq_server, purge_queue=purge_queue)
+def run_process(index, producers, mq_server, purge_queue):
+    worker = Worker(producers, index, mq_server=mq_server, purge_queue=purge_queue)
     worker.listen()
 
 
+def find_producers(module):
+    """Returns all subclasses of Producer defined in the module."""
+    from pymar.producer import Producer
+    return [value for name, value in sorted(vars(module).items())
+            if inspect.isclass(value) and issubclass(value, Producer)
+            and value.__module__ == module.__name__]
+
+
 def run(options):
     if options.verbose:
         logging.basicConfig(logging=logging.DEBUG,
@@ -131,10 +389,15 @@ def run(options):
         module = imp.load_module(options.file, fp, pathname, description)
         if options.data_source:
             globals().update({options.data_source: getattr(module, options.data_source)})
-        producer = getattr(module, options.producer)
+        if options.producer:
+            producers = [getattr(module, name.strip()) for name in options.producer.split(",")]
+        else:
+            producers = find_producers(module)
+            if not producers:
+                raise Exception("No producer classes found in %s" % options.file)
         #Run given number of workers.
         for index in range(options.workers_number):
-            mp.Process(target=run_process, args=(index, producer, options.mq_server, options.purge_queue)).start()
+            mp.Process(target=run_process, args=(index, producers, options.mq_server, options.purge_queue)).start()
 
         logging.getLogger("").info("%d workers running." % options.workers_number)
     finally:
@@ -148,6 +411,9 @@ if __name__ == "__main__":
 
     If you are going to send your data without using DataSource subclasses, don't specify it:
     worker.py ./examples.py -p SimpleProducer -q 127.0.0.1 -w 4
+
+    One worker may serve several producers. List them or omit -p to serve all producers from the file:
+    worker.py ./examples.py -p SimpleProducer,IntegrationProducer -q 127.0.0.1 -w 4
     """
     options = parse_options()
     run(options)